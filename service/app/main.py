@@ -4,28 +4,164 @@ FastAPI application for Iris ML service
 """
 
 import os
+import asyncio
+import queue
 import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable, Annotated
 
+import anyio
 import numpy as np
-import pandas as pd
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
 import joblib
+import xxhash
+from cachetools import LRUCache, TTLCache
+
+try:
+    import onnxruntime as ort
+except ImportError:  # ONNX Runtime is an optional inference backend
+    ort = None
+
+try:
+    from numba import njit
+except ImportError:  # Numba is an optional inference backend
+    njit = None
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# Background thread writing log records once the service is running
+_log_listener: Optional[QueueListener] = None
+
+def start_log_listener():
+    """Hand root log records to a background thread instead of writing inline"""
+    global _log_listener
+    
+    root = logging.getLogger()
+    if _log_listener is not None or not root.handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    _log_listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    _log_listener.start()
+
+def stop_log_listener():
+    """Flush queued log records and restore the original handlers"""
+    global _log_listener
+    
+    if _log_listener is None:
+        return
+    
+    _log_listener.stop()
+    logging.getLogger().handlers = list(_log_listener.handlers)
+    _log_listener = None
+
+# Whole responses are cached for repeated request bodies on these paths
+RESPONSE_CACHE_PATHS = frozenset({"/predict", "/predict_batch"})
+RESPONSE_CACHE_TTL = 60
+# The cache is bounded by the bytes of request and response bodies it holds
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Larger requests and responses are not cached so one big batch cannot flush the cache
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+# Maps (path, content type, body hash) to (request body, status, headers, body) of a
+# successful response
+_response_cache = TTLCache(
+    maxsize=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    getsizeof=lambda entry: len(entry[0]) + len(entry[3])
+)
+
+class ResponseCacheMiddleware:
+    """Answer repeated prediction requests before validation or inference run"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "POST"
+                or scope["path"] not in RESPONSE_CACHE_PATHS):
+            await self.app(scope, receive, send)
+            return
+        
+        # Read the full body up front so it can be hashed and replayed
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+        
+        # The content type decides whether the body validates, so it is part of the key
+        content_type = next((value for name, value in scope["headers"] if name == b"content-type"), b"")
+        key = (scope["path"], content_type, xxhash.xxh64_intdigest(body))
+        cached = _response_cache.get(key)
+        # The hash only narrows the lookup; a hit needs the same request body
+        if cached is not None and cached[0] == body:
+            _, status, headers, content = cached
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers + [(b"x-cache", b"HIT")]
+            })
+            await send({"type": "http.response.body", "body": content})
+            return
+        
+        body_replayed = False
+        
+        async def replay_body():
+            nonlocal body_replayed
+            if body_replayed:
+                return await receive()
+            body_replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        
+        response_start = None
+        response_body = []
+        
+        async def capture_response(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = message
+                message = {
+                    **message,
+                    "headers": list(message.get("headers", [])) + [(b"x-cache", b"MISS")]
+                }
+            elif message["type"] == "http.response.body":
+                response_body.append(message.get("body", b""))
+                if not message.get("more_body", False) and response_start["status"] == 200:
+                    content = b"".join(response_body)
+                    if len(body) + len(content) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                        _response_cache[key] = (
+                            body, 200, list(response_start.get("headers", [])), content
+                        )
+            await send(message)
+        
+        await self.app(scope, replay_body, capture_response)
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Iris ML Service",
     description="A machine learning service for Iris flower classification using Random Forest",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson encodes responses in C, much faster than the json module
+    default_response_class=ORJSONResponse
 )
 
+# Add response cache middleware, inside CORS so cached responses get its headers
+app.add_middleware(ResponseCacheMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -39,18 +175,128 @@ app.add_middleware(
 model = None
 metadata = None
 
+# Inference function used by the endpoints and the backend providing it
+_predict_proba: Optional[Callable[[np.ndarray], np.ndarray]] = None
+inference_backend: Optional[str] = None
+
+# Class names aligned with the probability columns, resolved once per model load
+_LABELS: np.ndarray = np.empty(0, dtype=object)
+
+# Number of input features expected by the model
+N_FEATURES = 4
+
+# Largest input that still fits in the float32 model input
+FLOAT32_MAX = float(np.finfo(np.float32).max)
+
+# Single predictions are cached on their exact features
+PREDICTION_CACHE_SIZE = 65536
+
+# Concurrent single predictions are coalesced into one model call
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "2"))
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", "64"))
+
+# Worker threads available to sync endpoints and offloaded inference
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "64"))
+
+# Maps feature tuples to (probability column, probability)
+_prediction_cache = LRUCache(maxsize=PREDICTION_CACHE_SIZE)
+
+# Per-thread scratch buffer for single-sample inference
+_scratch = threading.local()
+
+def _feature_buffer() -> np.ndarray:
+    """Return this thread's preallocated (1, N_FEATURES) float32 input buffer"""
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None:
+        buffer = np.empty((1, N_FEATURES), dtype=np.float32)
+        _scratch.buffer = buffer
+    return buffer
+
+def _predict_rows(rows: List[Tuple[float, ...]]) -> List[Tuple[int, float]]:
+    """Predict feature rows, returning (probability column, probability) for each"""
+    n = len(rows)
+    # A lone row reuses the scratch buffer instead of allocating
+    X = _feature_buffer() if n == 1 else np.empty((n, N_FEATURES), dtype=np.float32)
+    for i, row in enumerate(rows):
+        X[i] = row
+    
+    # One pass over the forest; the label is the most probable class
+    probabilities = _predict_proba(X)
+    pred_idx = probabilities.argmax(axis=1)
+    confidences = probabilities[np.arange(n), pred_idx].tolist()
+    return list(zip(pred_idx.tolist(), confidences))
+
+class MicroBatcher:
+    """Coalesce concurrent single-sample predictions into one model call"""
+    
+    def __init__(self, max_wait: float, max_size: int):
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._pending: List[Tuple[Tuple[float, ...], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+    
+    async def submit(self, row: Tuple[float, ...]) -> Tuple[int, float]:
+        """Queue a feature row and wait for its (probability column, probability)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        """Hand the pending rows to a task that predicts them together"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch: List[Tuple[Tuple[float, ...], asyncio.Future]]):
+        """Predict a batch off the event loop and resolve its futures"""
+        try:
+            results = await run_in_threadpool(_predict_rows, [row for row, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                future = batch[0][1]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # Retry rows one at a time so only the offending requests fail
+            for item in batch:
+                await self._run([item])
+            return
+        
+        for (_, future), result in zip(batch, results):
+            # Skip requests that were cancelled while waiting
+            if not future.done():
+                future.set_result(result)
+
+_batcher = MicroBatcher(MICRO_BATCH_WAIT_MS / 1000, MICRO_BATCH_MAX_SIZE)
+
 class IrisFeatures(BaseModel):
     """Pydantic model for Iris features"""
-    sepal_length: float = Field(..., ge=0, description="Sepal length in cm")
-    sepal_width: float = Field(..., ge=0, description="Sepal width in cm")
-    petal_length: float = Field(..., ge=0, description="Petal length in cm")
-    petal_width: float = Field(..., ge=0, description="Petal width in cm")
+    model_config = ConfigDict(extra="forbid", frozen=True)
+    
+    sepal_length: Annotated[float, Field(ge=0, le=FLOAT32_MAX, description="Sepal length in cm")]
+    sepal_width: Annotated[float, Field(ge=0, le=FLOAT32_MAX, description="Sepal width in cm")]
+    petal_length: Annotated[float, Field(ge=0, le=FLOAT32_MAX, description="Petal length in cm")]
+    petal_width: Annotated[float, Field(ge=0, le=FLOAT32_MAX, description="Petal width in cm")]
 
 class PredictionResponse(BaseModel):
     """Pydantic model for prediction response"""
     prediction: str
     probability: float
-    features: Dict[str, float]
+    features: IrisFeatures
 
 class HealthResponse(BaseModel):
     """Pydantic model for health check response"""
@@ -58,12 +304,74 @@ class HealthResponse(BaseModel):
     model_loaded: bool
     model_info: Optional[Dict[str, Any]] = None
 
+def load_onnx_predictor(onnx_path: Path) -> Callable[[np.ndarray], np.ndarray]:
+    """Create a predict_proba equivalent backed by an ONNX Runtime session"""
+    options = ort.SessionOptions()
+    # Inputs are a handful of rows; intra-op threading only adds overhead.
+    # Without a thread pool the session is also safe to inherit across fork.
+    options.intra_op_num_threads = 1
+    session = ort.InferenceSession(
+        str(onnx_path), sess_options=options, providers=["CPUExecutionProvider"]
+    )
+    input_name = session.get_inputs()[0].name
+    # Classifier graphs output (label, probabilities)
+    output_names = [session.get_outputs()[1].name]
+    
+    def predict_proba(X: np.ndarray) -> np.ndarray:
+        return session.run(output_names, {input_name: X})[0]
+    
+    return predict_proba
+
+def _forest_predict_proba(X, feature, threshold, children_left, children_right, value, roots):
+    """Average leaf class probabilities over flattened trees"""
+    n_samples = X.shape[0]
+    n_trees = roots.shape[0]
+    n_classes = value.shape[1]
+    probabilities = np.zeros((n_samples, n_classes))
+    
+    for i in range(n_samples):
+        for t in range(n_trees):
+            # Walk from the root until reaching a leaf (no left child)
+            node = roots[t]
+            while children_left[node] != -1:
+                if X[i, feature[node]] <= threshold[node]:
+                    node = children_left[node]
+                else:
+                    node = children_right[node]
+            for c in range(n_classes):
+                probabilities[i, c] += value[node, c]
+    
+    return probabilities / n_trees
+
+if njit is not None:
+    # nogil lets threadpool workers walk trees in parallel. No on-disk cache:
+    # the module is imported as both main and app.main, which would share one
+    # cache file, and gunicorn workers inherit the master's compiled kernel.
+    _forest_predict_proba = njit(nogil=True)(_forest_predict_proba)
+
+# Flattened forest arrays written by the trainer, in kernel argument order
+FOREST_TABLES = ("feature", "threshold", "children_left", "children_right", "value", "roots")
+
+def load_forest_predictor(forest_dir: Path) -> Callable[[np.ndarray], np.ndarray]:
+    """Create a predict_proba equivalent over memory-mapped flat tree tables"""
+    tables = tuple(
+        np.asarray(np.load(forest_dir / f"{name}.npy", mmap_mode="r"))
+        for name in FOREST_TABLES
+    )
+    
+    def predict_proba(X: np.ndarray) -> np.ndarray:
+        return _forest_predict_proba(X, *tables)
+    
+    return predict_proba
+
 def load_model():
     """Load the trained model and metadata"""
-    global model, metadata
+    global model, metadata, _predict_proba, inference_backend, _LABELS
     
     try:
         model_path = Path("models/iris_model.joblib")
+        onnx_path = Path("models/iris_model.onnx")
+        forest_dir = Path("models/forest")
         metadata_path = Path("models/model_metadata.json")
         
         if not model_path.exists():
@@ -72,7 +380,29 @@ def load_model():
         
         # Load model
         model = joblib.load(model_path)
-        logger.info("Model loaded successfully")
+        # Dispatching a few rows to a joblib pool costs more than the trees
+        model.n_jobs = 1
+        _predict_proba = model.predict_proba
+        inference_backend = "sklearn"
+        
+        # Prefer compiled backends when their artifacts are available
+        if njit is not None and forest_dir.exists():
+            try:
+                _predict_proba = load_forest_predictor(forest_dir)
+                inference_backend = "numba"
+            except Exception as e:
+                logger.warning(f"Failed to load forest tables: {str(e)}")
+        
+        if inference_backend == "sklearn" and ort is not None and onnx_path.exists():
+            try:
+                _predict_proba = load_onnx_predictor(onnx_path)
+                inference_backend = "onnxruntime"
+            except Exception as e:
+                logger.warning(f"Failed to load ONNX model, falling back to scikit-learn: {str(e)}")
+        
+        _prediction_cache.clear()
+        _response_cache.clear()
+        logger.info(f"Model loaded successfully (backend: {inference_backend})")
         
         # Load metadata
         if metadata_path.exists():
@@ -81,20 +411,51 @@ def load_model():
                 metadata = json.load(f)
             logger.info("Metadata loaded successfully")
         
+        # Map each probability column through classes_ to its name
+        if metadata and "target_names" in metadata:
+            names = [metadata["target_names"][c] for c in model.classes_]
+        else:
+            names = [f"class_{c}" for c in model.classes_]
+        _LABELS = np.array(names, dtype=object)
+        
         return True
         
     except Exception as e:
         logger.error(f"Failed to load model: {str(e)}")
         return False
 
+def warm_up_model():
+    """Run throwaway predictions so one-time setup costs are paid before serving"""
+    if model is None:
+        return
+    
+    try:
+        # Compiles the Numba kernel and initializes lazy backend state for
+        # both the single-row and batched input shapes
+        _predict_proba(np.zeros((1, N_FEATURES), dtype=np.float32))
+        _predict_proba(np.zeros((32, N_FEATURES), dtype=np.float32))
+        logger.info("Model warm-up completed")
+    except Exception as e:
+        logger.warning(f"Model warm-up failed: {str(e)}")
+
 @app.on_event("startup")
 async def startup_event():
-    """Load model on startup"""
-    logger.info("Starting Iris ML Service...")
-    load_model()
+    """Load model on startup unless it was preloaded before the fork"""
+    start_log_listener()
+    logger.info(f"Starting Iris ML Service (event loop: {type(asyncio.get_running_loop()).__module__})...")
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    if model is None:
+        load_model()
+    warm_up_model()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush pending log records on shutdown"""
+    logger.info("Stopping Iris ML Service...")
+    stop_log_listener()
 
 @app.get("/", response_model=Dict[str, str])
-async def root():
+def root():
     """Root endpoint"""
     return {
         "message": "Iris ML Service",
@@ -103,7 +464,7 @@ async def root():
     }
 
 @app.get("/health", response_model=HealthResponse)
-async def health_check():
+def health_check():
     """Health check endpoint"""
     model_info = None
     if metadata:
@@ -126,43 +487,28 @@ async def predict(features: IrisFeatures):
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
-        # Convert features to numpy array
-        feature_values = [
+        row = (
             features.sepal_length,
             features.sepal_width,
             features.petal_length,
             features.petal_width
-        ]
-        
-        X = np.array([feature_values])
-        
-        # Make prediction
-        prediction = model.predict(X)[0]
-        probabilities = model.predict_proba(X)[0]
-        
-        # Get predicted class name
-        if metadata and "target_names" in metadata:
-            predicted_class = metadata["target_names"][prediction]
-        else:
-            predicted_class = f"class_{prediction}"
+        )
         
-        # Get probability for predicted class
-        probability = float(probabilities[prediction])
+        # Make prediction, batching cache misses with concurrent requests
+        result = _prediction_cache.get(row)
+        if result is None:
+            result = await _batcher.submit(row)
+            _prediction_cache[row] = result
+        pred_idx, probability = result
         
-        # Convert features to dict
-        feature_dict = {
-            "sepal_length": features.sepal_length,
-            "sepal_width": features.sepal_width,
-            "petal_length": features.petal_length,
-            "petal_width": features.petal_width
-        }
+        predicted_class = _LABELS[pred_idx]
         
-        logger.info(f"Prediction made: {predicted_class} (confidence: {probability:.4f})")
+        logger.debug("Prediction made: %s (confidence: %.4f)", predicted_class, probability)
         
         return PredictionResponse(
             prediction=predicted_class,
             probability=probability,
-            features=feature_dict
+            features=features
         )
         
     except Exception as e:
@@ -170,49 +516,38 @@ async def predict(features: IrisFeatures):
         raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
 
 @app.post("/predict_batch")
-async def predict_batch(features_list: List[IrisFeatures]):
+def predict_batch(features_list: List[IrisFeatures]):
     """Predict multiple Iris samples"""
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
-        # Convert features to numpy array
-        X = []
-        for features in features_list:
-            X.append([
-                features.sepal_length,
-                features.sepal_width,
-                features.petal_length,
-                features.petal_width
-            ])
-        
-        X = np.array(X)
-        
-        # Make predictions
-        predictions = model.predict(X)
-        probabilities = model.predict_proba(X)
+        # Fill a preallocated float32 matrix one feature column at a time
+        n = len(features_list)
+        X = np.empty((n, N_FEATURES), dtype=np.float32)
+        X[:, 0] = np.fromiter((f.sepal_length for f in features_list), dtype=np.float32, count=n)
+        X[:, 1] = np.fromiter((f.sepal_width for f in features_list), dtype=np.float32, count=n)
+        X[:, 2] = np.fromiter((f.petal_length for f in features_list), dtype=np.float32, count=n)
+        X[:, 3] = np.fromiter((f.petal_width for f in features_list), dtype=np.float32, count=n)
+        
+        # Make predictions with a single pass over the forest
+        probabilities = _predict_proba(X)
+        pred_idx = probabilities.argmax(axis=1)
+        confidences = probabilities[np.arange(n), pred_idx].tolist()
+        predicted_classes = _LABELS[pred_idx].tolist()
         
         # Format results
-        results = []
-        for i, (pred, prob) in enumerate(zip(predictions, probabilities)):
-            if metadata and "target_names" in metadata:
-                predicted_class = metadata["target_names"][pred]
-            else:
-                predicted_class = f"class_{pred}"
-            
-            results.append({
+        results = [
+            {
                 "sample_id": i,
-                "prediction": predicted_class,
-                "probability": float(prob[pred]),
-                "features": {
-                    "sepal_length": features_list[i].sepal_length,
-                    "sepal_width": features_list[i].sepal_width,
-                    "petal_length": features_list[i].petal_length,
-                    "petal_width": features_list[i].petal_width
-                }
-            })
+                "prediction": predicted_classes[i],
+                "probability": confidences[i],
+                "features": features
+            }
+            for i, features in enumerate(features_list)
+        ]
         
-        logger.info(f"Batch prediction completed: {len(results)} samples")
+        logger.debug("Batch prediction completed: %d samples", len(results))
         
         return {"predictions": results}
         
@@ -221,7 +556,7 @@ async def predict_batch(features_list: List[IrisFeatures]):
         raise HTTPException(status_code=500, detail=f"Batch prediction failed: {str(e)}")
 
 @app.get("/model_info")
-async def get_model_info():
+def get_model_info():
     """Get model information"""
     if metadata is None:
         raise HTTPException(status_code=503, detail="Model metadata not available")
@@ -230,12 +565,9 @@ async def get_model_info():
         "model_type": metadata.get("model_type"),
         "feature_names": metadata.get("feature_names"),
         "target_names": metadata.get("target_names"),
+        "inference_backend": inference_backend,
         "model_parameters": {
             "n_estimators": metadata.get("n_estimators"),
             "max_depth": metadata.get("max_depth")
         }
     }
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
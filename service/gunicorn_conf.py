@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Gunicorn configuration for running the Iris ML service on all cores
+"""
+
+import gc
+import os
+
+from uvicorn.workers import UvicornWorker
+
+# Server socket
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+class UvloopWorker(UvicornWorker):
+    """Uvicorn worker pinned to the C-implemented event loop and HTTP parser"""
+    # The stock worker uses "auto", which silently falls back to asyncio/h11
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "loop": "uvloop", "http": "httptools"}
+
+# One uvicorn worker per core; sklearn inference is CPU-bound
+workers = int(os.getenv("UVICORN_WORKERS", os.cpu_count() or 1))
+worker_class = UvloopWorker
+
+# Import the app once in the master so workers share its pages copy-on-write
+preload_app = True
+
+# Logging
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+errorlog = "-"
+
+def when_ready(server):
+    """Load the model in the master before any worker is forked"""
+    from app.main import load_model, warm_up_model
+    
+    # Workers inherit the loaded model and skip loading it themselves. The
+    # forest tables are memory-mapped, so their pages are shared through the
+    # page cache; the joblib estimator is shared copy-on-write.
+    load_model()
+    # Compile the inference kernel once here rather than in every worker
+    warm_up_model()
+    # Keep the garbage collector from touching (and so copying) inherited objects
+    gc.freeze()
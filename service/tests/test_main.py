@@ -5,18 +5,42 @@ Unit tests for the Iris ML Service FastAPI application
 
 import pytest
 import json
+import asyncio
+import logging
 import numpy as np
 from fastapi.testclient import TestClient
+from pathlib import Path
 from unittest.mock import patch, MagicMock
 
 # Import the app
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'trainer'))
+import main
 from main import app
+from train_model import IrisModelTrainer
 
 client = TestClient(app)
 
+@pytest.fixture(scope="session")
+def trained_model_dir(tmp_path_factory):
+    """Train a model once per session into a temporary directory"""
+    root = tmp_path_factory.mktemp("service")
+    IrisModelTrainer(model_dir=str(root / "models")).run_training()
+    return root
+
+@pytest.fixture
+def loaded_model(trained_model_dir, monkeypatch):
+    """Load the trained model into the app and unload it afterwards"""
+    monkeypatch.chdir(trained_model_dir)
+    assert main.load_model() is True
+    yield main.model
+    main.model = None
+    main.metadata = None
+    main._prediction_cache.clear()
+    main._response_cache.clear()
+
 class TestHealthEndpoints:
     """Test health and status endpoints"""
     
@@ -95,6 +119,18 @@ class TestPredictionEndpoints:
         response = client.post("/predict", json=invalid_features)
         assert response.status_code == 422  # Validation error
     
+    def test_predict_value_beyond_float32(self):
+        """Test prediction with a value that overflows the float32 model input"""
+        overflowing_features = {
+            "sepal_length": 1e39,
+            "sepal_width": 3.0,
+            "petal_length": 6.1,
+            "petal_width": 2.3
+        }
+        
+        response = client.post("/predict", json=overflowing_features)
+        assert response.status_code == 422  # Validation error
+    
     def test_predict_missing_fields(self):
         """Test prediction with missing fields"""
         incomplete_features = {
@@ -106,6 +142,19 @@ class TestPredictionEndpoints:
         response = client.post("/predict", json=incomplete_features)
         assert response.status_code == 422  # Validation error
     
+    def test_predict_unknown_fields(self):
+        """Test prediction with unexpected extra fields"""
+        extra_features = {
+            "sepal_length": 5.1,
+            "sepal_width": 3.5,
+            "petal_length": 1.4,
+            "petal_width": 0.2,
+            "stem_length": 10.0
+        }
+        
+        response = client.post("/predict", json=extra_features)
+        assert response.status_code == 422  # Validation error
+    
     def test_predict_batch_valid_input(self):
         """Test batch prediction with valid input"""
         test_features_list = [
@@ -162,6 +211,270 @@ class TestPredictionEndpoints:
         response = client.post("/predict_batch", json=invalid_features_list)
         assert response.status_code == 422  # Validation error
 
+class TestLoadedModelPredictions:
+    """Test prediction endpoints against a trained model"""
+    
+    def test_predict_matches_model(self, loaded_model):
+        """Test single prediction agrees with the underlying model"""
+        test_features = {
+            "sepal_length": 6.3,
+            "sepal_width": 3.3,
+            "petal_length": 4.7,
+            "petal_width": 1.6
+        }
+        
+        response = client.post("/predict", json=test_features)
+        assert response.status_code == 200
+        data = response.json()
+        
+        X = np.array([list(test_features.values())], dtype=np.float32)
+        probabilities = loaded_model.predict_proba(X)[0]
+        expected = main.metadata["target_names"][int(probabilities.argmax())]
+        assert data["prediction"] == expected
+        assert data["probability"] == pytest.approx(float(probabilities.max()))
+        assert data["features"] == test_features
+    
+    def test_predict_batch_matches_model(self, loaded_model):
+        """Test batch predictions agree with the underlying model"""
+        test_features_list = [
+            {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2},
+            {"sepal_length": 6.3, "sepal_width": 3.3, "petal_length": 4.7, "petal_width": 1.6},
+            {"sepal_length": 7.2, "sepal_width": 3.0, "petal_length": 6.1, "petal_width": 2.3}
+        ]
+        
+        response = client.post("/predict_batch", json=test_features_list)
+        assert response.status_code == 200
+        predictions = response.json()["predictions"]
+        
+        X = np.array([list(f.values()) for f in test_features_list], dtype=np.float32)
+        probabilities = loaded_model.predict_proba(X)
+        for i, prediction in enumerate(predictions):
+            expected = main.metadata["target_names"][int(probabilities[i].argmax())]
+            assert prediction["prediction"] == expected
+            assert prediction["probability"] == pytest.approx(float(probabilities[i].max()))
+    
+    def test_predict_keeps_full_precision(self, loaded_model):
+        """Test single and batch predictions agree for inputs with more than 2 decimals"""
+        test_features = {
+            "sepal_length": 6.0,
+            "sepal_width": 2.9,
+            "petal_length": 2.449,
+            "petal_width": 1.6
+        }
+        
+        response = client.post("/predict", json=test_features)
+        assert response.status_code == 200
+        data = response.json()
+        
+        batch_response = client.post("/predict_batch", json=[test_features])
+        assert batch_response.status_code == 200
+        batch_prediction = batch_response.json()["predictions"][0]
+        
+        X = np.array([list(test_features.values())], dtype=np.float32)
+        probabilities = main._predict_proba(X)[0]
+        assert data["prediction"] == main.metadata["target_names"][int(probabilities.argmax())]
+        assert data["probability"] == pytest.approx(float(probabilities.max()))
+        assert data["prediction"] == batch_prediction["prediction"]
+        assert data["probability"] == batch_prediction["probability"]
+    
+    def test_onnx_backend_matches_model(self, loaded_model):
+        """Test the ONNX Runtime backend agrees with scikit-learn"""
+        pytest.importorskip("onnxruntime")
+        predict_proba = main.load_onnx_predictor(Path("models/iris_model.onnx"))
+        
+        X = np.random.default_rng(0).uniform(0, 8, size=(50, 4)).astype(np.float32)
+        np.testing.assert_allclose(predict_proba(X), loaded_model.predict_proba(X), atol=1e-5)
+    
+    def test_forest_backend_matches_model(self, loaded_model):
+        """Test the Numba forest kernel agrees with scikit-learn"""
+        pytest.importorskip("numba")
+        assert main.inference_backend == "numba"
+        
+        X = np.random.default_rng(0).uniform(0, 8, size=(50, 4)).astype(np.float32)
+        np.testing.assert_allclose(main._predict_proba(X), loaded_model.predict_proba(X))
+    
+    def test_feature_buffer_is_per_thread(self):
+        """Test the scratch buffer is reused within a thread but not shared"""
+        import threading
+        
+        buffer = main._feature_buffer()
+        assert buffer.shape == (1, main.N_FEATURES)
+        assert buffer.dtype == np.float32
+        assert main._feature_buffer() is buffer
+        
+        other = []
+        thread = threading.Thread(target=lambda: other.append(main._feature_buffer()))
+        thread.start()
+        thread.join()
+        assert other[0] is not buffer
+
+    def test_predict_reuses_cached_result(self, loaded_model, monkeypatch):
+        """Test repeated inputs are served from the prediction cache"""
+        test_features = {
+            "sepal_length": 5.1,
+            "sepal_width": 3.5,
+            "petal_length": 1.4,
+            "petal_width": 0.2
+        }
+        
+        first = client.post("/predict", json=test_features)
+        assert (5.1, 3.5, 1.4, 0.2) in main._prediction_cache
+        main._response_cache.clear()
+        
+        # A cache hit must not touch the model
+        monkeypatch.setattr(main, "_predict_proba", MagicMock(side_effect=RuntimeError))
+        second = client.post("/predict", json=test_features)
+        
+        assert first.status_code == second.status_code == 200
+        assert first.json() == second.json()
+    
+    def test_load_model_clears_prediction_cache(self, loaded_model):
+        """Test reloading the model invalidates cached predictions"""
+        main._prediction_cache[(5.1, 3.5, 1.4, 0.2)] = (0, 1.0)
+        
+        assert main.load_model() is True
+        assert len(main._prediction_cache) == 0
+
+class TestResponseCache:
+    """Test caching of whole prediction responses"""
+    
+    test_features = {
+        "sepal_length": 6.3,
+        "sepal_width": 3.3,
+        "petal_length": 4.7,
+        "petal_width": 1.6
+    }
+    
+    def test_repeated_body_is_served_from_cache(self, loaded_model):
+        """Test an identical request body is answered from the cache"""
+        first = client.post("/predict", json=self.test_features)
+        second = client.post("/predict", json=self.test_features)
+        
+        assert first.headers["x-cache"] == "MISS"
+        assert second.headers["x-cache"] == "HIT"
+        assert second.status_code == 200
+        assert second.json() == first.json()
+    
+    def test_batch_and_single_paths_are_cached_separately(self, loaded_model):
+        """Test the cache key includes the request path"""
+        client.post("/predict", json=self.test_features)
+        response = client.post("/predict_batch", json=[self.test_features])
+        assert response.headers["x-cache"] == "MISS"
+        assert len(response.json()["predictions"]) == 1
+    
+    def test_content_type_is_part_of_cache_key(self, loaded_model):
+        """Test a cached JSON response is not replayed for a non-JSON request"""
+        body = json.dumps(self.test_features)
+        
+        plain = client.post("/predict", content=body, headers={"Content-Type": "text/plain"})
+        assert plain.status_code == 422
+        
+        response = client.post("/predict", content=body, headers={"Content-Type": "application/json"})
+        assert response.status_code == 200
+        
+        plain = client.post("/predict", content=body, headers={"Content-Type": "text/plain"})
+        assert plain.status_code == 422
+        assert plain.headers["x-cache"] == "MISS"
+    
+    def test_hash_collision_is_not_a_hit(self, loaded_model, monkeypatch):
+        """Test a different body with the same hash is not served the cached response"""
+        monkeypatch.setattr(main.xxhash, "xxh64_intdigest", lambda body: 0)
+        other_features = {**self.test_features, "petal_length": 1.4, "petal_width": 0.2}
+        
+        first = client.post("/predict", json=self.test_features)
+        second = client.post("/predict", json=other_features)
+        
+        assert second.headers["x-cache"] == "MISS"
+        assert second.json()["features"] == other_features
+        assert second.json()["prediction"] != first.json()["prediction"]
+    
+    def test_large_responses_are_not_cached(self, loaded_model, monkeypatch):
+        """Test responses above the per-entry size limit are never stored"""
+        monkeypatch.setattr(main, "RESPONSE_CACHE_MAX_ENTRY_BYTES", 16)
+        client.post("/predict", json=self.test_features)
+        
+        response = client.post("/predict", json=self.test_features)
+        assert response.status_code == 200
+        assert response.headers["x-cache"] == "MISS"
+        assert len(main._response_cache) == 0
+    
+    def test_errors_are_not_cached(self, monkeypatch):
+        """Test failed requests are never replayed from the cache"""
+        monkeypatch.setattr(main, "model", None)
+        first = client.post("/predict", json=self.test_features)
+        second = client.post("/predict", json=self.test_features)
+        
+        assert first.status_code == second.status_code == 503
+        assert second.headers["x-cache"] == "MISS"
+    
+    def test_load_model_clears_response_cache(self, loaded_model):
+        """Test reloading the model invalidates cached responses"""
+        client.post("/predict", json=self.test_features)
+        assert main.load_model() is True
+        
+        response = client.post("/predict", json=self.test_features)
+        assert response.headers["x-cache"] == "MISS"
+
+class TestMicroBatcher:
+    """Test coalescing of concurrent single predictions"""
+    
+    rows = [(5.1, 3.5, 1.4, 0.2), (6.3, 3.3, 4.7, 1.6), (7.2, 3.0, 6.1, 2.3)]
+    
+    def _submit_concurrently(self, batcher, monkeypatch):
+        """Submit all rows at once, returning results and model call sizes"""
+        calls = []
+        predict_rows = main._predict_rows
+        
+        def spy(rows):
+            calls.append(len(rows))
+            return predict_rows(rows)
+        
+        monkeypatch.setattr(main, "_predict_rows", spy)
+        
+        async def submit_all():
+            return await asyncio.gather(*(batcher.submit(row) for row in self.rows))
+        
+        return asyncio.run(submit_all()), calls
+    
+    def test_concurrent_requests_share_one_model_call(self, loaded_model, monkeypatch):
+        """Test concurrent submissions are predicted together"""
+        batcher = main.MicroBatcher(max_wait=0.01, max_size=64)
+        expected = main._predict_rows(self.rows)
+        
+        results, calls = self._submit_concurrently(batcher, monkeypatch)
+        assert calls == [3]
+        assert results == expected
+    
+    def test_full_batch_is_flushed_immediately(self, loaded_model, monkeypatch):
+        """Test batches are capped at max_size"""
+        batcher = main.MicroBatcher(max_wait=0.01, max_size=2)
+        
+        results, calls = self._submit_concurrently(batcher, monkeypatch)
+        assert calls == [2, 1]
+        assert len(results) == 3
+    
+    def test_model_errors_only_fail_offending_rows(self, loaded_model, monkeypatch):
+        """Test a row the model rejects does not fail rows batched with it"""
+        batcher = main.MicroBatcher(max_wait=0.01, max_size=64)
+        expected = main._predict_rows(self.rows)
+        predict_proba = main._predict_proba
+        
+        def reject_large(X):
+            if (X > 50).any():
+                raise ValueError("bad row")
+            return predict_proba(X)
+        
+        monkeypatch.setattr(main, "_predict_proba", reject_large)
+        
+        async def submit_all():
+            rows = self.rows + [(100.0, 3.0, 6.1, 2.3)]
+            return await asyncio.gather(*(batcher.submit(row) for row in rows),
+                                        return_exceptions=True)
+        
+        results = asyncio.run(submit_all())
+        assert results[:3] == expected
+        assert isinstance(results[3], ValueError)
+
 class TestEdgeCases:
     """Test edge cases and error handling"""
     
@@ -216,6 +529,33 @@ class TestEdgeCases:
         else:
             assert response.status_code == 200
 
+class TestLogging:
+    """Test background log handling"""
+    
+    def test_log_listener_delivers_records(self):
+        """Test records queued while the listener runs reach the original handlers"""
+        from logging.handlers import QueueHandler
+        
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        root = logging.getLogger()
+        original_handlers = root.handlers[:]
+        root.handlers = [handler]
+        
+        try:
+            main.start_log_listener()
+            assert len(root.handlers) == 1
+            assert isinstance(root.handlers[0], QueueHandler)
+            
+            main.logger.warning("queued record")
+            main.stop_log_listener()
+            
+            assert root.handlers == [handler]
+            assert [record.getMessage() for record in records] == ["queued record"]
+        finally:
+            root.handlers = original_handlers
+
 class TestModelLoading:
     """Test model loading functionality"""
     
@@ -232,6 +572,65 @@ class TestModelLoading:
         result = load_model()
         assert result is True
     
+    def test_model_loading_disables_parallel_inference(self, loaded_model):
+        """Test the loaded model predicts without a joblib worker pool"""
+        assert loaded_model.n_jobs == 1
+    
+    def test_trainer_selects_cheapest_grid_point(self, tmp_path, monkeypatch):
+        """Test the trainer returns the cheapest grid point once it clears MIN_CV_ACCURACY"""
+        monkeypatch.setattr(IrisModelTrainer, "N_ESTIMATORS_GRID", [20, 10])
+        monkeypatch.setattr(IrisModelTrainer, "MAX_DEPTH_GRID", [4, 3])
+        monkeypatch.setattr(IrisModelTrainer, "MIN_CV_ACCURACY", 0)
+        trainer = IrisModelTrainer(model_dir=str(tmp_path))
+        X, y, _, _ = trainer.load_data()
+        
+        assert trainer.select_hyperparameters(X, y) == (10, 3)
+    
+    def test_trainer_falls_back_to_best_score(self, tmp_path, monkeypatch, caplog):
+        """Test the trainer uses the best grid point when none clears MIN_CV_ACCURACY"""
+        monkeypatch.setattr(IrisModelTrainer, "N_ESTIMATORS_GRID", [10, 20])
+        monkeypatch.setattr(IrisModelTrainer, "MAX_DEPTH_GRID", [3, 4])
+        monkeypatch.setattr(IrisModelTrainer, "MIN_CV_ACCURACY", 1.01)
+        scores = {(10, 3): 0.90, (10, 4): 0.93, (20, 3): 0.92, (20, 4): 0.91}
+        monkeypatch.setattr(
+            "train_model.cross_val_score",
+            lambda model, X, y, cv: np.array([scores[(model.n_estimators, model.max_depth)]])
+        )
+        trainer = IrisModelTrainer(model_dir=str(tmp_path))
+        X, y, _, _ = trainer.load_data()
+        
+        with caplog.at_level(logging.WARNING, logger="train_model"):
+            assert trainer.select_hyperparameters(X, y) == (10, 4)
+        assert "No candidate reached CV accuracy 1.01" in caplog.text
+    
+    def test_class_names_fall_back_without_metadata(self, loaded_model, monkeypatch):
+        """Test generic class names are used when metadata is missing"""
+        exists = main.Path.exists
+        monkeypatch.setattr(main, "metadata", None)
+        monkeypatch.setattr(main.Path, "exists",
+                            lambda path: path.name != "model_metadata.json" and exists(path))
+        
+        assert main.load_model() is True
+        assert main._LABELS.tolist() == ["class_0", "class_1", "class_2"]
+    
+    def test_warm_up_runs_single_and_batch_predictions(self, loaded_model, monkeypatch):
+        """Test warm-up exercises both input shapes"""
+        predict_proba = MagicMock(wraps=main._predict_proba)
+        monkeypatch.setattr(main, "_predict_proba", predict_proba)
+        
+        main.warm_up_model()
+        shapes = [call.args[0].shape for call in predict_proba.call_args_list]
+        assert shapes == [(1, main.N_FEATURES), (32, main.N_FEATURES)]
+    
+    def test_warm_up_without_model(self, monkeypatch):
+        """Test warm-up is a no-op when no model is loaded"""
+        predict_proba = MagicMock()
+        monkeypatch.setattr(main, "model", None)
+        monkeypatch.setattr(main, "_predict_proba", predict_proba)
+        
+        main.warm_up_model()
+        predict_proba.assert_not_called()
+    
     @patch('main.Path.exists')
     def test_model_loading_failure(self, mock_exists):
         """Test model loading failure when file doesn't exist"""
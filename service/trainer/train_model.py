@@ -14,6 +14,12 @@ from sklearn.metrics import classification_report, accuracy_score
 from sklearn.model_selection import train_test_split, cross_val_score
 import joblib
 
+try:
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+except ImportError:  # ONNX export is optional
+    convert_sklearn = None
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,6 +30,12 @@ logger = logging.getLogger(__name__)
 class IrisModelTrainer:
     """Trainer class for Iris dataset using Random Forest"""
     
+    # Hyperparameter grid; inference cost grows with both dimensions
+    N_ESTIMATORS_GRID = [10, 20, 50]
+    MAX_DEPTH_GRID = [3, 4, 6]
+    # Smallest forest reaching this mean cross-validation accuracy wins
+    MIN_CV_ACCURACY = 0.95
+    
     def __init__(self, model_dir: str = "models"):
         self.model_dir = Path(model_dir)
         self.model_dir.mkdir(exist_ok=True)
@@ -35,7 +47,8 @@ class IrisModelTrainer:
         """Load Iris dataset"""
         logger.info("Loading Iris dataset...")
         iris = load_iris()
-        X = iris.data
+        # Train on float32 so the served model sees the same dtype at inference
+        X = iris.data.astype(np.float32)
         y = iris.target
         feature_names = iris.feature_names
         target_names = iris.target_names
@@ -46,6 +59,34 @@ class IrisModelTrainer:
         
         return X, y, feature_names, target_names
     
+    def select_hyperparameters(self, X: np.ndarray, y: np.ndarray) -> Tuple[int, int]:
+        """Pick the cheapest (n_estimators, max_depth) meeting MIN_CV_ACCURACY"""
+        logger.info("Selecting hyperparameters...")
+        
+        candidates = sorted(
+            ((n, d) for n in self.N_ESTIMATORS_GRID for d in self.MAX_DEPTH_GRID),
+            key=lambda params: (params[0] * params[1], params[0])
+        )
+        
+        best_params, best_score = None, -1.0
+        for n_estimators, max_depth in candidates:
+            model = RandomForestClassifier(
+                n_estimators=n_estimators,
+                max_depth=max_depth,
+                random_state=42,
+                n_jobs=-1
+            )
+            score = cross_val_score(model, X, y, cv=5).mean()
+            logger.info(f"n_estimators={n_estimators}, max_depth={max_depth}: CV accuracy {score:.4f}")
+            
+            if score >= self.MIN_CV_ACCURACY:
+                return n_estimators, max_depth
+            if score > best_score:
+                best_params, best_score = (n_estimators, max_depth), score
+        
+        logger.warning(f"No candidate reached CV accuracy {self.MIN_CV_ACCURACY}, using the best one")
+        return best_params
+    
     def train_model(self, X: np.ndarray, y: np.ndarray) -> RandomForestClassifier:
         """Train Random Forest model"""
         logger.info("Training Random Forest model...")
@@ -55,10 +96,11 @@ class IrisModelTrainer:
             X, y, test_size=0.2, random_state=42, stratify=y
         )
         
-        # Initialize and train model
+        # Initialize and train the smallest adequate model
+        n_estimators, max_depth = self.select_hyperparameters(X_train, y_train)
         model = RandomForestClassifier(
-            n_estimators=100,
-            max_depth=10,
+            n_estimators=n_estimators,
+            max_depth=max_depth,
             random_state=42,
             n_jobs=-1
         )
@@ -105,6 +147,61 @@ class IrisModelTrainer:
         
         logger.info(f"Model saved to: {model_path}")
         logger.info(f"Metadata saved to: {metadata_path}")
+        
+        self.export_forest_tables(model)
+        
+        if convert_sklearn is not None:
+            self.export_onnx(model, len(metadata['feature_names']))
+        else:
+            logger.warning("skl2onnx not installed, skipping ONNX export")
+    
+    def export_forest_tables(self, model: RandomForestClassifier):
+        """Flatten all trees into contiguous node arrays for the Numba kernel"""
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+        
+        def offset_children(children: np.ndarray, root: int) -> np.ndarray:
+            # Leaves are marked with -1 and must stay that way
+            return np.where(children == -1, -1, children + root)
+        
+        # Leaf class counts normalized to per-tree probabilities
+        values = [tree.value[:, 0, :] / tree.value[:, 0, :].sum(axis=1, keepdims=True) for tree in trees]
+        
+        tables = {
+            'feature': np.concatenate([tree.feature for tree in trees]).astype(np.int32),
+            'threshold': np.concatenate([tree.threshold for tree in trees]),
+            'children_left': np.concatenate([
+                offset_children(tree.children_left, root) for tree, root in zip(trees, roots)
+            ]).astype(np.int32),
+            'children_right': np.concatenate([
+                offset_children(tree.children_right, root) for tree, root in zip(trees, roots)
+            ]).astype(np.int32),
+            'value': np.concatenate(values),
+            'roots': roots.astype(np.int32)
+        }
+        
+        forest_dir = self.model_dir / "forest"
+        forest_dir.mkdir(exist_ok=True)
+        for name, table in tables.items():
+            np.save(forest_dir / f"{name}.npy", np.ascontiguousarray(table))
+        
+        logger.info(f"Forest tables saved to: {forest_dir}")
+    
+    def export_onnx(self, model: RandomForestClassifier, n_features: int):
+        """Export the model to ONNX for compiled inference"""
+        # Kept at float32; see "Inference Backend" in the README for why not int8
+        onnx_model = convert_sklearn(
+            model,
+            initial_types=[('X', FloatTensorType([None, n_features]))],
+            # Emit probabilities as a plain tensor instead of a list of dicts
+            options={id(model): {'zipmap': False}}
+        )
+        
+        onnx_path = self.model_dir / "iris_model.onnx"
+        with open(onnx_path, 'wb') as f:
+            f.write(onnx_model.SerializeToString())
+        
+        logger.info(f"ONNX model saved to: {onnx_path}")
     
     def run_training(self):
         """Complete training pipeline"""